@@ -2,22 +2,64 @@ import os
 import json
 import datetime
 import time
+import threading
+import concurrent.futures
 import dotenv
 import requests
+from requests.adapters import HTTPAdapter
+import orjson
 import re
 import gzip
+import io
 import boto3
+import botocore.config
+from boto3.s3.transfer import TransferConfig
 import graphyte
 import tracemalloc
+import resource
 import logging
 
+# Intel ISA-L (python-isal) is a much faster, format compatible replacement for gzip. Use it when available.
+try:
+    from isal import igzip, isal_zlib
+except ImportError:
+    igzip = None
+
+# Amount of exported days after which the state file is written
+STATE_FLUSH_DAYS = 32
+
+# Minimum size of the chunks in which ELF formatted logs are handed over for compression.
+# Large chunks keep the number of deflate calls, and therefore write syscalls, low.
+ELF_CHUNK_SIZE = 512 * 1024
+
+# Buffer size of the local gzipped files, so compressed data also reaches the disk in large writes
+FILE_BUFFER_SIZE = 1024 * 1024
+
+# Log message: replace spaces with tabs, except when within double quotes
+_ELF_RE = re.compile(r'"[^"]+"|(\s)')
+
+# Fast path for log messages without double quotes: map every character matched by \s onto a tab
+_WS_TO_TAB = str.maketrans({c: "\t" for c in map(chr, range(0x3001)) if c.isspace()})
+
+# Exporter key: strip braces and double quotes, replace anything else that is not a-z with an underscore
+_KEY_RE = re.compile(r"([{}\"])|[^a-z]")
+
+
+def _elf_repl(match):
+    return "\t" if match.group(1) else match.group(0)
+
+
+def _key_repl(match):
+    return "" if match.group(1) else "_"
+
 
 class LokiExporter:
     def __init__(self):
         dotenv.load_dotenv()
 
         # Init logging
-        if os.getenv("STAGE") == "dev":
+        self.stage = os.getenv("STAGE")
+        if self.stage == "dev":
             log_level = logging.DEBUG
         else:
             # stage == prod
@@ -34,21 +76,70 @@ class LokiExporter:
         # State
         self.file_state = "conf/loki-export-state.json"
         self.dict_state = self.init_state()
+        self.state_unflushed = 0
 
         # Metric setup
         self.graphite_host = os.getenv("GRAPHITE_HOST")
         self.graphite_prefix = os.getenv("GRAPHITE_PREFIX")
         self.dict_metrics = dict()
+        # Metrics are updated from the worker threads
+        self.metrics_lock = threading.Lock()
+
+        # Amount of days that are exported simultaneously
+        if "max_workers" in self.config:
+            self.max_workers = int(self.config["max_workers"])
+        else:
+            self.max_workers = 4
+
+        # Loki connection, kept alive across all queries of this run
+        self.loki_session = requests.Session()
+        loki_adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.max_workers, max_retries=3)
+        self.loki_session.mount("http://", loki_adapter)
+        self.loki_session.mount("https://", loki_adapter)
+        # Loki compresses its responses on request, requests decompresses them transparently
+        self.loki_session.headers["Accept-Encoding"] = "gzip, deflate"
+
+        # Loki query endpoint
+        self.loki_query_url = self.config["loki_host"] + "/loki/api/v1/query_range"
+
+        # Lines per Loki query. Large pages spread the fixed cost of each query over more lines.
+        if "max_lines_per_query" in self.config:
+            self.max_lines = int(self.config["max_lines_per_query"])
+        else:
+            self.max_lines = 5000
 
         # Storage
-        if "s3" in self.config["storage"]:
+        # Log text compresses well even at the fastest level, which is much cheaper on CPU than the default
+        if "compresslevel" in self.config["storage"]:
+            self.compress_level = int(self.config["storage"]["compresslevel"])
+        else:
+            self.compress_level = 1
+
+        # ISA-L only supports compression levels 0-3
+        if igzip is not None and self.compress_level <= isal_zlib.ISAL_BEST_COMPRESSION:
+            self.gzip_module = igzip
+        else:
+            self.gzip_module = gzip
+
+        self.local_enabled = "local" in self.config["storage"]
+        if self.local_enabled:
+            self.local_export_path = self.config["storage"]["local"]["filepath"]
+        # Local directories that are known to exist
+        self.local_dirs = set()
+
+        self.s3_enabled = "s3" in self.config["storage"]
+        if self.s3_enabled:
             aws_session = boto3.Session(
                 aws_access_key_id=os.getenv("AWS_ACCESS_KEY_ID"),
                 aws_secret_access_key=os.getenv("AWS_ACCESS_KEY_SECRET")
             )
 
-            self.s3_connection = aws_session.resource("s3")
+            s3_config = botocore.config.Config(max_pool_connections=50, retries={"max_attempts": 5, "mode": "adaptive"})
+            self.s3_connection = aws_session.resource("s3", config=s3_config)
             self.s3_log_bucket = self.s3_connection.Bucket(self.config["storage"]["s3"]["aws_bucket"])
+            # Our gzipped log files stay well below the threshold, so they are uploaded in a single request
+            self.s3_transfer_config = TransferConfig(multipart_threshold=64 * 1024 * 1024, max_concurrency=4,
+                                                     use_threads=True)
 
     def init_state(self):
         if not os.path.exists(self.file_state):
@@ -64,10 +155,24 @@ class LokiExporter:
         return json.loads(content)
 
     def save_state(self, key, ts):
+        # State is kept in memory, and only written to file every so many days (see flush_state)
         self.dict_state[key] = ts
+        self.state_unflushed += 1
+
+        if self.state_unflushed >= STATE_FLUSH_DAYS:
+            self.flush_state()
 
-        with open(self.file_state, "w", encoding='latin-1') as f_state:
+    def flush_state(self):
+        if self.state_unflushed == 0:
+            return
+
+        # Write to a temporary file first, and atomically replace the state file with it
+        file_state_tmp = self.file_state + ".tmp"
+        with open(file_state_tmp, "w", encoding='latin-1') as f_state:
             json.dump(self.dict_state, f_state, indent=2)
+        os.replace(file_state_tmp, self.file_state)
+
+        self.state_unflushed = 0
 
     def get_state(self, key):
         if key in self.dict_state:
@@ -82,13 +187,15 @@ class LokiExporter:
             return json_config
 
     def inc_metric(self, metric, incr=1):
-        if metric not in self.dict_metrics:
-            self.dict_metrics[metric] = incr
-        else:
-            self.dict_metrics[metric] += incr
+        with self.metrics_lock:
+            if metric not in self.dict_metrics:
+                self.dict_metrics[metric] = incr
+            else:
+                self.dict_metrics[metric] += incr
 
     def set_metric(self, metric, value):
-        self.dict_metrics[metric] = value
+        with self.metrics_lock:
+            self.dict_metrics[metric] = value
 
     def get_metrics(self):
         return self.dict_metrics
@@ -124,62 +231,92 @@ class LokiExporter:
         lst_log = list()
 
         # Query Loki for our logs
-        loki_host = self.config["loki_host"]
-        if "max_lines_per_query" in self.config:
-            limit = "&limit=" + str(self.config["max_lines_per_query"])
-        else:
-            limit = ""
-        url = loki_host + "/loki/api/v1/query_range?query=" + query + "&start=" + ts_start + "&end=" + ts_end + \
-            "&direction=forward" + limit
-        # print(url)
-        result = requests.get(url)
-        dict_results = result.json()
+        # requests takes care of URL encoding the parameters, the query contains characters like { } " and |
+        dict_params = {
+            "query": query,
+            "start": ts_start,
+            "end": ts_end,
+            "direction": "forward",
+            "limit": self.max_lines
+        }
+        result = self.loki_session.get(self.loki_query_url, params=dict_params)
+        dict_results = orjson.loads(result.content)
 
         if dict_results["status"] == "success":
             if "result" in dict_results["data"]:
-                if len(dict_results["data"]["result"]) > 0:
+                # A batch without any log lines is treated as no result at all
+                if len(dict_results["data"]["result"]) > 0 and len(dict_results["data"]["result"][0]["values"]) > 0:
                     lst_log = dict_results["data"]["result"]
 
         return lst_log
 
-    def format_logs_to_elf(self, lst_logs):
-        lst_formatted = list()
-        for line in lst_logs[0]["values"]:
+    def format_logs_to_elf(self, values, f_out):
+        """
+        Format the logs as latin-1 encoded ELF and write them into the binary file object f_out, in chunks of
+        whole lines of at least ELF_CHUNK_SIZE bytes (except for the last one).
+        values can be any iterable of (timestamp in ns, log message) pairs, like the "values" of a Loki stream.
+        """
+        line_count = 0
+        last_ts = -1
+        date = b""
+        buf_elf = bytearray()
+        append = buf_elf.extend
+        for line in values:
             # Format timestamp into readable date and time
-            # Remove the last 9 numbers from timestamp (microseconds part)
-            ts = int(line[0][:-9])
-            date = datetime.datetime.fromtimestamp(ts).strftime("%Y-%m-%d\t%H:%M:%S")
+            # Drop the nanoseconds part of the timestamp
+            ts = int(line[0]) // 1000000000
+            # Consecutive lines mostly share the same second, so only format the date when it changes
+            if ts != last_ts:
+                date = datetime.datetime.fromtimestamp(ts).strftime("%Y-%m-%d\t%H:%M:%S").encode('latin-1')
+                last_ts = ts
 
             # Format actual log message: replace spaces with tabs, except when within double quotes
-            regex = r'"[^"]+"|(\s)'
-            msg = re.sub(regex, lambda m: "\t" if m.group(1) else m.group(0), line[1])
-
-            lst_formatted.append(date + "\t" + msg)
-
-        self.logger.debug("Formatted list contains {0} lines".format(len(lst_formatted)))
-
-        return "\n".join(lst_formatted)
-
-    def format_logs_to_json(self, lst_logs):
-        # Append beginning and end curly braces
-        str_logs = "{ \"values\": " + str(lst_logs[0]["values"]) + "}"
-
-        # Replace single quotes with double quotes
-        # Replace comma with \n
-        str_logs = str_logs.replace("'", "\"")
+            msg = line[1]
+            if '"' in msg:
+                msg = _ELF_RE.sub(_elf_repl, msg)
+            else:
+                msg = msg.translate(_WS_TO_TAB)
+
+            line_count += 1
+            append(date)
+            append(b"\t")
+            append(msg.encode('latin-1'))
+            append(b"\n")
+
+            # The buffer is handed over as is, it is not copied into an intermediate bytes object
+            if len(buf_elf) >= ELF_CHUNK_SIZE:
+                f_out.write(buf_elf)
+                buf_elf.clear()
+
+        if buf_elf:
+            f_out.write(buf_elf)
+
+        self.logger.debug("Formatted list contains {0} lines".format(line_count))
+
+    def format_logs_to_json(self, lst_logs, f_out):
+        # Dump the values in one go and hand them to f_out in a single write. With indent, json.dump() uses the same
+        # pure Python encoder, but writes every token separately, which is considerably slower.
+        # Non-ASCII characters are escaped, so the result is latin-1 safe.
+        f_out.write(json.dumps({"values": lst_logs[0]["values"]}, indent=2).encode('latin-1'))
+
+    def write_logs(self, lst_logs, export_format, file_obj):
+        """
+        Format the logs and stream them, gzipped, straight into the given binary file object.
+        Formatting, encoding and compressing happen in a single pass over the logs.
+        """
+        with self.gzip_module.GzipFile(fileobj=file_obj, mode='wb', compresslevel=self.compress_level) as f:
+            # elf = Extended Log Format
+            if export_format == "elf":
+                self.format_logs_to_elf(lst_logs[0]["values"], f)
 
-        str_logs = json.dumps(json.loads(str_logs), indent=2)
-        return str_logs
+            # defaults to json (unmodified Loki format)
+            else:
+                self.format_logs_to_json(lst_logs, f)
 
     def export_logs(self, lst_logs, export_format, key, ts_day, iteration=1):
-        # First, we format the logs
-        # elf = Extended Log Format
-        if export_format == "elf":
-            str_logs = self.format_logs_to_elf(lst_logs)
-
-        # defaults to json (unmodified Loki format)
-        else:
-            str_logs = self.format_logs_to_json(lst_logs)
+        # Nothing to format, compress or upload
+        if len(lst_logs) == 0 or len(lst_logs[0]["values"]) == 0:
+            return
 
         # Determine day
         obj_day = datetime.datetime.fromtimestamp(int(ts_day[:-9]))
@@ -190,35 +327,37 @@ class LokiExporter:
         file_name = key + "-" + str(obj_day.year) + str(obj_day.month).zfill(2) + str(obj_day.day).zfill(2) + \
             "." + str(iteration).zfill(4) + ".log.gz"
 
-        if "local" in self.config["storage"]:
-            local_export_path = self.config["storage"]["local"]["filepath"]
-            full_path = local_export_path + "/" + file_path + "/" + file_name
+        # The logs are formatted and compressed only once. When storing locally, that file is also the one
+        # being uploaded to S3. Otherwise, the data is compressed in memory.
+        if self.local_enabled:
+            full_path = self.local_export_path + "/" + file_path + "/" + file_name
             self.logger.debug("Local file to be written: " + full_path)
-            if not os.path.exists(local_export_path + "/" + file_path):
-                os.makedirs(local_export_path + "/" + file_path)
+            local_dir = self.local_export_path + "/" + file_path
+            if local_dir not in self.local_dirs:
+                os.makedirs(local_dir, exist_ok=True)
+                self.local_dirs.add(local_dir)
 
             # Create gzipped log file
-            with gzip.open(full_path, 'wb') as f:
-                f.write(bytes(str_logs, 'latin-1'))
-                self.inc_metric("files-written.local")
-                self.inc_metric("lines-written.local", len(lst_logs[0]["values"]))
-
-        if "s3" in self.config["storage"]:
-            # Store data temporarily
-            tmp_file = "/tmp/" + file_name
-            with gzip.open(tmp_file, 'wb') as f:
-                f.write(bytes(str_logs, 'latin-1'))
+            with open(full_path, 'wb', buffering=FILE_BUFFER_SIZE) as f_local:
+                self.write_logs(lst_logs, export_format, f_local)
+            self.inc_metric("files-written.local")
+            self.inc_metric("lines-written.local", len(lst_logs[0]["values"]))
 
+        if self.s3_enabled:
             # Upload the file
             s3_path = file_path + "/" + file_name
             self.logger.debug("S3 file to be written: " + s3_path)
-            res = self.s3_log_bucket.upload_file(tmp_file, s3_path)
-
-            # If all went OK, remove the file
-            if res:
-                self.inc_metric("files-written.s3")
-                self.inc_metric("lines-written.s3", len(lst_logs[0]["values"]))
-                os.remove(tmp_file)
+            # The upload functions return None and raise on failure
+            if self.local_enabled:
+                self.s3_log_bucket.upload_file(full_path, s3_path, Config=self.s3_transfer_config)
+            else:
+                buf_logs = io.BytesIO()
+                self.write_logs(lst_logs, export_format, buf_logs)
+                buf_logs.seek(0)
+                self.s3_log_bucket.upload_fileobj(buf_logs, s3_path, Config=self.s3_transfer_config)
+
+            self.inc_metric("files-written.s3")
+            self.inc_metric("lines-written.s3", len(lst_logs[0]["values"]))
 
     def __calculate_holdoff_timestamp(self):
         # Determining the amount of holdoff days
@@ -233,22 +372,66 @@ class LokiExporter:
         ts_holdoff = str(ts_today - (holdoff_days * 86400)) + "000000000"
         return ts_holdoff
 
+    def export_day(self, query, export_format, key, ts_start, ts_end, max_lines):
+        # Initial batch
+        lst_logs = self.get_logs(query, ts_start, ts_end)
+        batch_nr = 1
+
+        if len(lst_logs) > 0:
+
+            batch_size = len(lst_logs[0]["values"])
+            self.logger.debug("Size of batch is {0}".format(batch_size))
+
+            while batch_size == max_lines:
+                # If size of returned log lines is equal to max lines, it can be assumed that
+                # there are more results available. Therefore, we have to 'page' our results, as indicated
+                # here: https://github.com/grafana/loki/issues/1625#issuecomment-582192791
+
+                # Export logs to storage
+                self.export_logs(lst_logs, export_format, key, ts_start, batch_nr)
+
+                # Pick up timestamp from last log line
+                ts_start_interim = lst_logs[0]["values"][-1][0]
+
+                # Grab new batch
+                lst_logs = self.get_logs(query, ts_start_interim, ts_end)
+
+                if len(lst_logs) > 0:
+                    batch_size = len(lst_logs[0]["values"])
+                else:
+                    batch_size = 0
+
+                batch_nr += 1
+
+            # Export the tail end of logs
+            if len(lst_logs) > 0:
+                self.export_logs(lst_logs, export_format, key, ts_start, batch_nr)
+                self.logger.debug("Size of final batch is {0}".format(len(lst_logs[0]["values"])))
+
+            self.logger.debug("Amount of batches: {0}".format(batch_nr))
+
+            self.inc_metric("batches-sent", batch_nr)
+
     def run(self):
-        tracemalloc.start()
+        # Tracing every allocation slows down the interpreter considerably, so we only do that on dev
+        if self.stage == "dev":
+            tracemalloc.start()
         time_start = time.perf_counter()
 
-        max_lines = self.config["max_lines_per_query"]
+        max_lines = self.max_lines
+        ts_holdoff = self.__calculate_holdoff_timestamp()
         if "max_days_per_exporter" in self.config:
             max_days = int(self.config["max_days_per_exporter"])
         else:
             max_days = 0
 
+        # Work out the days to export for every exporter first. Invalid settings or state then fail the run
+        # before any day has been exported.
+        lst_exporters = list()
         for item in self.config["exporters"]:
             if item["active"] is True:
                 export_format = item["format"]
-                key = re.sub(r"([{}\"])|[^a-z]", lambda m: "" if m.group(1) else "_", item["query"])
-
-                ts_holdoff = self.__calculate_holdoff_timestamp()
+                key = _KEY_RE.sub(_key_repl, item["query"])
 
                 # Try to fetch the start time from the state file
                 state_time = self.get_state(key)
@@ -262,6 +445,7 @@ class LokiExporter:
 
                 # We fetch the logs per day
                 # If start_time in current day, then stop (we only export through 'yesterday')
+                lst_days = list()
                 day_counter = 0
                 while ts_start < ts_holdoff:
                     # Maximum number of days per run (to keep Loki memory in check)
@@ -270,59 +454,64 @@ class LokiExporter:
                         if day_counter > max_days:
                             break
 
-                    # Initial batch
-                    lst_logs = self.get_logs(item["query"], ts_start, ts_end)
-                    batch_nr = 1
+                    lst_days.append((ts_start, ts_end))
 
-                    if len(lst_logs) > 0:
-
-                        batch_size = len(lst_logs[0]["values"])
-                        self.logger.debug("Size of batch is {0}".format(batch_size))
-
-                        while batch_size == max_lines:
-                            # If size of returned log lines is equal to max lines, it can be assumed that
-                            # there are more results available. Therefore, we have to 'page' our results, as indicated
-                            # here: https://github.com/grafana/loki/issues/1625#issuecomment-582192791
-
-                            # Export logs to storage
-                            self.export_logs(lst_logs, export_format, key, ts_start, batch_nr)
-
-                            # Pick up timestamp from last log line
-                            ts_start_interim = lst_logs[0]["values"][-1][0]
-
-                            # Grab new batch
-                            lst_logs = self.get_logs(item["query"], ts_start_interim, ts_end)
-
-                            if len(lst_logs) > 0:
-                                batch_size = len(lst_logs[0]["values"])
-                            else:
-                                batch_size = 0
-
-                            batch_nr += 1
-
-                        # Export the tail end of logs
-                        if len(lst_logs) > 0:
-                            self.export_logs(lst_logs, export_format, key, ts_start, batch_nr)
-                            self.logger.debug("Size of final batch is {0}".format(len(lst_logs[0]["values"])))
+                    # recalculate ts_start and ts_end, for the next day
+                    ts_start, ts_end = self.get_time_boundaries(datetime.datetime.fromtimestamp(int(ts_end[:-9])))
 
-                        self.logger.debug("Amount of batches: {0}".format(batch_nr))
+                lst_exporters.append((key, item["query"], export_format, lst_days))
+
+        # Days are fetched and exported concurrently, each day paging through its own batches
+        lst_exporter_days = list()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for key, query, export_format, lst_days in lst_exporters:
+                lst_futures = list()
+                for ts_start, ts_end in lst_days:
+                    future = executor.submit(self.export_day, query, export_format, key, ts_start, ts_end, max_lines)
+                    lst_futures.append((ts_end, future))
+
+                lst_exporter_days.append((key, lst_futures))
+
+            # Store last timestamp, in order of days, so the state never skips over a day that is still running
+            # or has failed. Each exporter is walked on its own, so a failing exporter does not keep the finished
+            # days of the others out of the state.
+            error = None
+            try:
+                for key, lst_days in lst_exporter_days:
+                    for ts_end, future in lst_days:
+                        # Days dropped after a failure end the recorded progress of this exporter
+                        if future.cancelled():
+                            break
 
-                        self.inc_metric("batches-sent", batch_nr)
+                        exception = future.exception()
+                        if exception is not None:
+                            self.logger.error("Exporting {0} up to {1} failed: {2!r}".format(key, ts_end, exception))
+                            if error is None:
+                                error = exception
+                                # Drop all days that have not started yet, they would be exported again next run
+                                executor.shutdown(wait=True, cancel_futures=True)
+                            break
 
-                    # store last timestamp
-                    self.save_state(key, ts_end)
+                        self.save_state(key, ts_end)
+            finally:
+                self.flush_state()
 
-                    # recalculate ts_start and ts_end, for the next day
-                    ts_start, ts_end = self.get_time_boundaries(datetime.datetime.fromtimestamp(int(ts_end[:-9])))
+            if error is not None:
+                raise error
 
         # Finally, collect performance metrics
         time_end = time.perf_counter()
-        mem_usage = tracemalloc.get_traced_memory()
-        tracemalloc.stop()
-
         self.set_metric("time-elapsed", time_end - time_start)
-        self.set_metric("memory-usage.min", mem_usage[0])
-        self.set_metric("memory-usage.max", mem_usage[1])
+
+        if self.stage == "dev":
+            mem_usage = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+            self.set_metric("memory-usage.min", mem_usage[0])
+            self.set_metric("memory-usage.max", mem_usage[1])
+        else:
+            # Peak resident set size, reported in kilobytes on Linux
+            self.set_metric("memory-usage.max", resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024)
 
         self.logger.info(self.get_metrics())
 